@@ -1,13 +1,32 @@
 import os
 import io
+import pickle
+import queue
+import random
+import atexit
 import json
 import sys
 import logging
 import datetime
+import functools
 import re
+import tempfile
+import time
+from dataclasses import dataclass, field
 import gspread
-from threading import Thread
+import requests
+from google.auth.exceptions import TransportError
+from google.oauth2.service_account import Credentials
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Timer, Lock, RLock
 from flask import Flask
+import tornado.web
+
+try:
+    import orjson
+except ImportError:  # orjson прискорює (де)серіалізацію, але не обов'язковий
+    orjson = None
 
 from telegram import (
     Update,
@@ -18,6 +37,7 @@ from telegram import (
     InlineKeyboardButton,
     ReplyKeyboardRemove,
 )
+from telegram.error import RetryAfter
 from telegram.ext import (
     Updater,
     CommandHandler,
@@ -26,36 +46,91 @@ from telegram.ext import (
     Filters,
     CallbackQueryHandler,
     ConversationHandler,
+    PicklePersistence,
 )
 
 # === Налаштування логування ===
+# Рівень логування задається LOG_LEVEL (наприклад, WARNING у продакшені), за замовчуванням INFO
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+_LOG_LEVEL_VALID = LOG_LEVEL in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=LOG_LEVEL if _LOG_LEVEL_VALID else "INFO"
 )
 logger = logging.getLogger(__name__)
+if not _LOG_LEVEL_VALID:
+    logger.warning("Невідомий LOG_LEVEL %r, використовується INFO", LOG_LEVEL)
 
-# === Якщо credentials.json не існує, створюємо його зі змінної середовища ===
-if not os.path.exists("credentials.json"):
-    creds = os.environ.get("GOOGLE_CREDENTIALS")
-    if creds:
-        try:
-            json.loads(creds)  # Перевірка валідності JSON
-            with open("credentials.json", "w", encoding="utf-8") as f:
-                f.write(creds)
-            logger.info("Файл credentials.json створено з Render Secrets.")
-        except json.JSONDecodeError as e:
-            logger.error("Невірний формат JSON у змінній GOOGLE_CREDENTIALS: %s", e)
-            sys.exit(1)
-    else:
+# === credentials.json синхронізується зі змінною середовища GOOGLE_CREDENTIALS ===
+def valid_service_account(text: str) -> bool:
+    """Дешева перевірка: JSON-об'єкт ключа сервісного акаунта з потрібними полями."""
+    try:
+        info = json.loads(text)
+    except ValueError:
+        return False
+    return (isinstance(info, dict) and info.get("type") == "service_account"
+            and bool(info.get("client_email")) and bool(info.get("private_key")))
+
+def read_credentials_file():
+    try:
+        with open("credentials.json", "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+# Без валідних облікових даних бот працює, але реєстрації йдуть у файл замість Google Sheets
+SHEETS_ENABLED = True
+creds = os.environ.get("GOOGLE_CREDENTIALS")
+if creds:
+    if not valid_service_account(creds):
+        logger.error("GOOGLE_CREDENTIALS не є JSON-ключем сервісного акаунта, запис у Google Sheets вимкнено!")
+        SHEETS_ENABLED = False
+    elif read_credentials_file() != creds:
+        # Перезаписуємо і наявний файл: інакше виправлена змінна не діяла б до ручного видалення.
+        # Атомарний запис: перезапуск посеред запису не залишить обрізаний файл.
+        tmp = tempfile.NamedTemporaryFile("w", delete=False, dir=".", encoding="utf-8")
+        with tmp:
+            tmp.write(creds)
+        os.replace(tmp.name, "credentials.json")
+        logger.info("Файл credentials.json створено з Render Secrets.")
+else:
+    existing = read_credentials_file()
+    if existing is None:
         logger.error("Змінна середовища GOOGLE_CREDENTIALS не знайдена!")
         sys.exit(1)
+    if not valid_service_account(existing):
+        logger.error("credentials.json не є JSON-ключем сервісного акаунта, запис у Google Sheets вимкнено!")
+        SHEETS_ENABLED = False
 
 # =======================
 # Налаштування бота та імена файлів
 # =======================
 TOKEN = os.environ.get("TELEGRAM_TOKEN")
 SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID")
-ADMIN_IDS = [1124775269, 382701754]  # ID адміністраторів
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # публічна адреса сервісу; без неї — long polling
+BOOTSTRAP_RETRIES = 6  # повторів setWebhook при старті у режимі webhook (типово PTB — жодного)
+WORKERS = 8  # потоків Dispatcher для хендлерів з run_async=True
+def parse_admin_ids(value: str) -> frozenset:
+    """ID адміністраторів через кому; некоректні записи пропускаються з попередженням."""
+    ids = set()
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            ids.add(int(item))
+        except ValueError:
+            logger.warning("Некоректний запис у ADMIN_IDS пропущено: %r", item)
+    return frozenset(ids)
+
+# ID адміністраторів: зі змінної ADMIN_IDS через кому, інакше — початковий список
+ADMIN_IDS = parse_admin_ids(os.environ.get("ADMIN_IDS", "1124775269,382701754"))
+if not ADMIN_IDS:
+    logger.error("ADMIN_IDS не містить жодного коректного ID — адмін-панель недоступна!")
+
+# Пул для блокуючої роботи з Google Sheets, щоб не тримати хендлери
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+BROADCAST_WORKERS = 16  # потоків розсилки, тобто одночасних запитів до Telegram
 
 # Використання внутрішнього сховища процесу
 DATA_DIR = os.getenv("DATA_DIR", "./data")
@@ -65,6 +140,7 @@ if not os.path.exists(DATA_DIR):
 SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
 USERS_FILE = os.path.join(DATA_DIR, "users.txt")
 MESSAGE_FILE = os.path.join(DATA_DIR, "message.txt")
+PERSISTENCE_FILE = os.path.join(DATA_DIR, "ptb_state.pkl")
 
 # Дефолтні налаштування заходу
 default_settings = {
@@ -90,37 +166,115 @@ def ensure_local_file(file_path, default_content):
         except Exception as e:
             logger.error("Помилка створення файлу %s: %s", file_path, e)
 
+_write_lock = Lock()  # одночасні адмін-збереження інакше писали б в один і той самий .tmp
+
+def write_file_atomic(file_path, data: bytes):
+    """
+    Записує файл через тимчасовий file_path + ".tmp" і os.replace:
+    читач або збій посеред запису ніколи не побачать половину файлу.
+    """
+    tmp_file = file_path + ".tmp"
+    with _write_lock:
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file_path)
+
+# === JSON: orjson, якщо встановлений, інакше stdlib json ===
+def dumps_json(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+def loads_json(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# === Налаштування заходу ===
+@dataclass
+class EventSettings:
+    """
+    Поточні дата, час і локація заходу. Адмін-хендлери змінюють їх з різних потоків,
+    тому запис і узгоджене читання кількох полів йдуть під lock.
+    """
+    date: str
+    time: str
+    location: str
+    lock: RLock = field(default_factory=RLock, repr=False, compare=False)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                "event_date": self.date,
+                "event_time": self.time,
+                "event_location": self.location,
+            }
+
+event_settings = EventSettings(
+    date=default_settings["event_date"],
+    time=default_settings["event_time"],
+    location=default_settings["event_location"],
+)
+
 # === Завантаження та збереження налаштувань із внутрішнього сховища ===
 def load_settings():
-    global event_date, event_time, event_location
-    default_settings_content = json.dumps(default_settings, ensure_ascii=False, indent=4)
+    default_settings_content = dumps_json(default_settings).decode("utf-8")
     ensure_local_file(SETTINGS_FILE, default_settings_content)
     try:
-        with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
-            settings = json.load(f)
-            event_date = settings.get("event_date", default_settings["event_date"])
-            event_time = settings.get("event_time", default_settings["event_time"])
-            event_location = settings.get("event_location", default_settings["event_location"])
+        with open(SETTINGS_FILE, "rb") as f:
+            settings = loads_json(f.read())
+        with event_settings.lock:
+            event_settings.date = settings.get("event_date", default_settings["event_date"])
+            event_settings.time = settings.get("event_time", default_settings["event_time"])
+            event_settings.location = settings.get("event_location", default_settings["event_location"])
             logger.info("Налаштування завантажено: Дата: %s, Час: %s, Локація: %s",
-                        event_date, event_time, event_location)
+                        event_settings.date, event_settings.time, event_settings.location)
     except Exception as e:
         logger.error("Помилка завантаження налаштувань: %s", e)
 
 def save_settings():
-    settings = {
-        "event_date": event_date,
-        "event_time": event_time,
-        "event_location": event_location,
-    }
+    settings = event_settings.as_dict()
     try:
-        with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
-            json.dump(settings, f, ensure_ascii=False, indent=4)
+        write_file_atomic(SETTINGS_FILE, dumps_json(settings))
         logger.info("Налаштування збережено локально.")
     except Exception as e:
         logger.error("Помилка збереження налаштувань: %s", e)
 
+SAVE_SETTINGS_DELAY = 0.5  # секунд: кілька змін поспіль зливаються в один запис
+_save_timer = None
+_save_timer_lock = Lock()
+
+def schedule_save_settings():
+    """Відкладає save_settings; кожен новий виклик переносить запис ще на SAVE_SETTINGS_DELAY."""
+    global _save_timer
+    with _save_timer_lock:
+        if _save_timer is not None:
+            _save_timer.cancel()
+        _save_timer = Timer(SAVE_SETTINGS_DELAY, _run_scheduled_save)
+        _save_timer.daemon = True
+        _save_timer.start()
+
+def _run_scheduled_save():
+    global _save_timer
+    with _save_timer_lock:
+        _save_timer = None
+    save_settings()
+
+def flush_settings():
+    """Якщо запис налаштувань ще чекає на таймер — виконує його зараз."""
+    global _save_timer
+    with _save_timer_lock:
+        timer, _save_timer = _save_timer, None
+    if timer is not None:
+        timer.cancel()
+        save_settings()
+
 # === Функції для роботи з текстом повідомлення реєстрації ===
-def load_message_text():
+_message_text = None  # кеш MESSAGE_FILE; змінюється лише через save_message_text
+
+def read_message_file():
     ensure_local_file(MESSAGE_FILE, default_message_text)
     try:
         with open(MESSAGE_FILE, "r", encoding="utf-8") as f:
@@ -130,101 +284,392 @@ def load_message_text():
         logger.error("Помилка завантаження файлу %s: %s", MESSAGE_FILE, e)
         return default_message_text
 
+def load_message_text():
+    """Повертає текст повідомлення з пам'яті; файл читається лише при першому зверненні."""
+    global _message_text
+    if _message_text is None:
+        _message_text = read_message_file()
+    return _message_text
+
 def save_message_text(new_text):
+    global _message_text
     try:
-        with open(MESSAGE_FILE, "w", encoding="utf-8") as f:
-            f.write(new_text)
+        write_file_atomic(MESSAGE_FILE, new_text.encode("utf-8"))
+        _message_text = new_text
         logger.info("Текст повідомлення збережено у %s.", MESSAGE_FILE)
     except Exception as e:
         logger.error("Помилка збереження файлу %s: %s", MESSAGE_FILE, e)
 
 # === Завантаження списку користувачів із внутрішнього сховища ===
-def load_users():
-    ensure_local_file(USERS_FILE, "")  # Порожній файл за замовчуванням
+USERS = set()        # ID користувачів (int); після старту саме ця копія є канонічною
+_users_lock = Lock()
+_USERS_LOADED = False
+
+def compact_users_file(lines: int):
+    """
+    Перезаписує USERS_FILE без дублікатів і зіпсованих рядків (атомарно через os.replace).
+    Викликається лише з load_users, поки файл ще не відкрито на дописування.
+    """
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            users = f.read().splitlines()
-        logger.info("Завантажено %d користувачів із %s", len(users), USERS_FILE)
-        return users
+        unique = sorted(USERS)
+        write_file_atomic(USERS_FILE, "".join(f"{uid}\n" for uid in unique).encode())
+        logger.info("Файл %s ущільнено: %d рядків -> %d", USERS_FILE, lines, len(unique))
     except Exception as e:
-        logger.error("Помилка при зчитуванні %s: %s", USERS_FILE, e)
-        return []
+        logger.error("Помилка ущільнення %s: %s", USERS_FILE, e)
+
+def load_users():
+    """Зчитує USERS_FILE у USERS. Файл читається лише один раз — при старті."""
+    global _USERS_LOADED
+    with _users_lock:
+        if _USERS_LOADED:
+            return
+        ensure_local_file(USERS_FILE, "")  # Порожній файл за замовчуванням
+        try:
+            # Рядки йдуть одразу в множину, без проміжного рядка файлу та списку;
+            # int() приймає байти, тож файл читається без декодування в str
+            lines = 0
+            with open(USERS_FILE, "rb") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        USERS.add(int(line))
+                    except ValueError:
+                        pass  # порожній або зіпсований рядок — прибере compact_users_file
+            _USERS_LOADED = True
+            logger.info("Завантажено %d користувачів із %s", len(USERS), USERS_FILE)
+            if lines != len(USERS):
+                compact_users_file(lines)
+        except Exception as e:
+            logger.error("Помилка при зчитуванні %s: %s", USERS_FILE, e)
 
 # === Функції для роботи з користувачами ===
+_users_fd = None  # дескриптор USERS_FILE (O_APPEND), відкривається при першому додаванні
+
+def close_users_file():
+    global _users_fd
+    with _users_lock:
+        if _users_fd is not None:
+            os.close(_users_fd)
+            _users_fd = None
+
 def add_user(user_id: int):
+    global _users_fd
+    if user_id in USERS:
+        return
     try:
-        users = load_users()
-        if str(user_id) not in users:
-            with open(USERS_FILE, "a", encoding="utf-8") as f:
-                f.write(str(user_id) + "\n")
-            logger.info("Користувача %d додано у %s", user_id, USERS_FILE)
+        with _users_lock:
+            if user_id in USERS:
+                return
+            if _users_fd is None:
+                _users_fd = os.open(USERS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                atexit.register(close_users_file)
+            # Один write() на користувача: O_APPEND гарантує запис цілого рядка в кінець файлу
+            os.write(_users_fd, f"{user_id}\n".encode())
+            USERS.add(user_id)
+        logger.info("Користувача %d додано у %s", user_id, USERS_FILE)
     except Exception as e:
         logger.error("Помилка додавання користувача: %s", e)
 
-def store_registration(user_data: dict):
-    """Записуємо дані користувача в Google Sheets, додаємо стовпець з часом та датою реєстрації."""
-    try:
-        gc = gspread.service_account(filename="credentials.json")
-        sh = gc.open_by_key(SPREADSHEET_ID)
-        sheet_name = event_date
+# === Google Sheets: кешований клієнт і буфер реєстрацій ===
+SHEET_HEADER = ["Ім'я", "Телефон", "Telegram", "Джерело", "Час реєстрації"]
+FLUSH_INTERVAL = 5       # секунд, протягом яких накопичуються рядки
+FLUSH_BATCH_SIZE = 20    # при такій кількості рядків запис іде одразу
+SHEETS_MAX_ATTEMPTS = 5  # спроб запису при 429/5xx (затримки 1, 2, 4, 8 с)
+SHEET_ID_ATTEMPTS = 3      # спроб створити аркуш, якщо випадковий sheetId уже зайнятий
+SHEETS_MAX_PENDING = 1000  # більше рядків у буфері не тримаємо — решта йде у FAILED_REGISTRATIONS_FILE
+# Рядки, які не вдалося записати в таблицю (JSON-рядок [аркуш, рядок] на реєстрацію), для ручного перенесення
+FAILED_REGISTRATIONS_FILE = os.path.join(DATA_DIR, "failed_registrations.jsonl")
+
+_gc = None
+_sh = None
+_sheet_ids = None        # назва аркуша (дата заходу) -> sheetId; None — ще не отримано
+_pending_rows = deque()  # (назва аркуша, рядок) очікують запису
+_pending_lock = Lock()
+_flush_lock = Lock()
+_flush_timer = None
+_failed_lock = Lock()
+
+def get_spreadsheet():
+    """
+    Повертає таблицю, авторизуючись у Google лише при першому зверненні.
+    Клієнт тримає одну AuthorizedSession, тож TLS-з'єднання та токен
+    перевикористовуються між запитами.
+    """
+    global _gc, _sh
+    if _sh is None:
+        creds = Credentials.from_service_account_file(
+            "credentials.json", scopes=gspread.auth.DEFAULT_SCOPES
+        )
+        _gc = gspread.authorize(creds)
+        _sh = _gc.open_by_key(SPREADSHEET_ID)
+    return _sh
+
+def ensure_worksheet(sheet_name: str):
+    """
+    Гарантує, що аркуш для дати заходу існує.
+    Список аркушів запитується один раз. Новий аркуш разом із заголовком створюється
+    одним (атомарним) batchUpdate з випадковим sheetId у межах int32; при 400 список
+    перечитується — аркуш міг створити інший запис, інакше пробуємо інший id.
+    """
+    global _sheet_ids
+    sh = get_spreadsheet()
+    # Локальна копія: admin_set_date може скинути _sheet_ids з іншого потоку
+    sheet_ids = _sheet_ids
+    if sheet_ids is None:
+        sheet_ids = _sheet_ids = {ws.title: ws.id for ws in sh.worksheets()}
+    if sheet_name in sheet_ids:
+        return
+    for attempt in range(SHEET_ID_ATTEMPTS):
+        sheet_id = random.randint(1, 2 ** 31 - 1)
         try:
-            worksheet = sh.worksheet(sheet_name)
-        except gspread.exceptions.WorksheetNotFound:
-            worksheet = sh.add_worksheet(title=sheet_name, rows="100", cols="20")
-            worksheet.append_row(["Ім'я", "Телефон", "Telegram", "Джерело", "Час реєстрації"])
-        registration_time = datetime.datetime.now().strftime("%H:%M\n%d.%m.%Y")
-        worksheet.append_row([
-            user_data.get("name"),
-            user_data.get("phone"),
-            user_data.get("username"),
-            user_data.get("source"),
-            registration_time
-        ])
+            sh.batch_update({"requests": [
+                {"addSheet": {"properties": {
+                    "sheetId": sheet_id,
+                    "title": sheet_name,
+                    "gridProperties": {"rowCount": 100, "columnCount": 20},
+                }}},
+                {"appendCells": {
+                    "sheetId": sheet_id,
+                    "rows": [{"values": [{"userEnteredValue": {"stringValue": h}} for h in SHEET_HEADER]}],
+                    "fields": "userEnteredValue",
+                }},
+            ]})
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code != 400:
+                raise
+            sheet_ids = _sheet_ids = {ws.title: ws.id for ws in sh.worksheets()}
+            if sheet_name in sheet_ids:
+                return
+            if attempt == SHEET_ID_ATTEMPTS - 1:
+                raise
+            continue
+        sheet_ids[sheet_name] = sheet_id
+        return
+
+def invalidate_worksheets():
+    """Змушує наступний запис заново отримати список аркушів."""
+    global _sheet_ids
+    _sheet_ids = None
+
+def is_retryable_sheets_error(e: Exception) -> bool:
+    """Чи є сенс повторити запис пізніше: 429/5xx від Google або мережева помилка."""
+    if isinstance(e, gspread.exceptions.APIError):
+        status = e.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, TransportError))
+
+def append_registrations(sheet_name: str, rows: list):
+    """Один values.append в аркуш; на 429/5xx від Google повторює з експоненційною затримкою."""
+    refreshed = False
+    for attempt in range(SHEETS_MAX_ATTEMPTS):
+        try:
+            ensure_worksheet(sheet_name)
+            get_spreadsheet().values_append(
+                "'{}'!A1".format(sheet_name.replace("'", "''")),
+                params={"valueInputOption": "RAW"},
+                body={"values": rows},
+            )
+            return
+        except gspread.exceptions.APIError as e:
+            status = e.response.status_code
+            if status == 400 and not refreshed and attempt < SHEETS_MAX_ATTEMPTS - 1:
+                # Аркуш могли видалити вручну — перечитуємо список аркушів і пробуємо ще раз
+                refreshed = True
+                invalidate_worksheets()
+                continue
+            if not is_retryable_sheets_error(e) or attempt == SHEETS_MAX_ATTEMPTS - 1:
+                raise
+            delay = 2 ** attempt
+            logger.warning("Google Sheets відповів %s, повтор через %d с", status, delay)
+            time.sleep(delay)
+
+def _schedule_flush():
+    """Запускає таймер скидання буфера, якщо він ще не запущений. Викликати під _pending_lock."""
+    global _flush_timer
+    if _flush_timer is None:
+        _flush_timer = Timer(FLUSH_INTERVAL, flush_registrations)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+def save_failed_registrations(sheet_name: str, rows: list):
+    """Дописує рядки, які не потраплять у таблицю, у FAILED_REGISTRATIONS_FILE."""
+    data = "".join(json.dumps([sheet_name, row], ensure_ascii=False) + "\n" for row in rows)
+    try:
+        with _failed_lock:
+            with open(FAILED_REGISTRATIONS_FILE, "a", encoding="utf-8") as f:
+                f.write(data)
+        logger.error("%d реєстрацій для аркуша %s збережено у %s", len(rows), sheet_name, FAILED_REGISTRATIONS_FILE)
     except Exception as e:
-        logger.error("Помилка запису в Google Sheets: %s", e)
+        logger.error("Помилка збереження реєстрацій у %s, %d рядків втрачено: %s",
+                     FAILED_REGISTRATIONS_FILE, len(rows), e)
+
+def flush_registrations():
+    """Записує всі накопичені рядки: один values.append на кожен аркуш."""
+    global _flush_timer
+    with _flush_lock:
+        with _pending_lock:
+            _flush_timer = None
+            pending = list(_pending_rows)
+            _pending_rows.clear()
+        if not pending:
+            return
+        batches = {}
+        for sheet_name, row in pending:
+            batches.setdefault(sheet_name, []).append(row)
+        for sheet_name, rows in batches.items():
+            try:
+                append_registrations(sheet_name, rows)
+                logger.info("Записано %d реєстрацій в аркуш %s", len(rows), sheet_name)
+            except Exception as e:
+                if not is_retryable_sheets_error(e):
+                    # Невірний SPREADSHEET_ID, доступ, облікові дані — повтор не допоможе
+                    logger.error("Помилка запису в Google Sheets, повтору не буде: %s", e)
+                    save_failed_registrations(sheet_name, rows)
+                    continue
+                with _pending_lock:
+                    requeue = len(_pending_rows) + len(rows) <= SHEETS_MAX_PENDING
+                    if requeue:
+                        _pending_rows.extendleft((sheet_name, row) for row in reversed(rows))
+                        _schedule_flush()
+                if requeue:
+                    logger.error("Помилка запису в Google Sheets, %d рядків повернуто в буфер: %s", len(rows), e)
+                else:
+                    logger.error("Помилка запису в Google Sheets, буфер переповнений: %s", e)
+                    save_failed_registrations(sheet_name, rows)
+
+def store_registration(user_data: dict):
+    """
+    Додаємо дані користувача (з часом та датою реєстрації) у буфер.
+    Буфер скидається в Google Sheets за таймером або при досягненні FLUSH_BATCH_SIZE.
+    """
+    registration_time = datetime.datetime.now().strftime("%H:%M\n%d.%m.%Y")
+    row = [
+        user_data.get("name"),
+        user_data.get("phone"),
+        user_data.get("username"),
+        user_data.get("source"),
+        registration_time
+    ]
+    if not SHEETS_ENABLED:
+        save_failed_registrations(event_settings.date, [row])
+        return
+    with _pending_lock:
+        _pending_rows.append((event_settings.date, row))
+        flush_now = len(_pending_rows) >= FLUSH_BATCH_SIZE
+        if not flush_now:
+            _schedule_flush()
+    if flush_now:
+        flush_registrations()
 
 # === Допоміжні функції ===
-def get_weekday(date_str: str) -> str:
+# Знахідний відмінок для «в {день}», індекс — datetime.weekday()
+_WEEKDAYS = ("понеділок", "вівторок", "середу", "четвер", "п’ятницю", "суботу", "неділю")
+
+@functools.lru_cache(maxsize=8)
+def _weekday_for_day(date_str: str, day_ordinal: int) -> str:
+    """День тижня заходу date_str («дд.мм») відносно дня day_ordinal."""
     try:
         day, month = map(int, date_str.split('.'))
     except Exception as e:
         logger.error("Невірний формат дати: %s. Помилка: %s", date_str, e)
         return "невідомий день"
-    now = datetime.datetime.now()
-    year = now.year
+    today = datetime.date.fromordinal(day_ordinal)
     try:
-        event_date_obj = datetime.datetime(year, month, day)
+        event_date_obj = datetime.date(today.year, month, day)
     except ValueError:
         return "невідомий день"
-    if event_date_obj < now:
+    # Північ дня заходу вже минула, якщо це сьогодні або раніше — беремо наступний рік
+    if event_date_obj <= today:
         try:
-            event_date_obj = datetime.datetime(year + 1, month, day)
+            event_date_obj = datetime.date(today.year + 1, month, day)
         except ValueError:
             pass
-    weekdays = {
-        0: "понеділок",
-        1: "вівторок",
-        2: "середу",
-        3: "четвер",
-        4: "п’ятницю",
-        5: "суботу",
-        6: "неділю",
-    }
-    return weekdays.get(event_date_obj.weekday(), "невідомий день")
-
-def get_invitation_message() -> str:
-    weekday = get_weekday(event_date)
-    message = (
-        f"Привіт! Запрошую тебе на вечірку в {weekday}, {event_date}, початок о {event_time}\n"
-        f"{event_location}\n\n"
-        "Чи будеш ти з нами?"
-    )
-    return message
+    return _WEEKDAYS[event_date_obj.weekday()]
+
+def get_weekday(date_str: str) -> str:
+    # Ключ змінюється щодня, тож кеш не росте і не віддає застарілий день
+    return _weekday_for_day(date_str, datetime.date.today().toordinal())
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """
+    Незмінна інлайн-клавіатура: JSON будується один раз при створенні.
+    Bot викликає reply_markup.to_json() на кожне повідомлення — тут це просто повернення рядка.
+    """
+
+    __slots__ = ("_json",)
+
+    def __init__(self, inline_keyboard, **_kwargs):
+        super().__init__(inline_keyboard, **_kwargs)
+        self._json = super().to_json()
+
+    def to_json(self) -> str:
+        return self._json
+
+# Інлайн-клавіатури однакові для всіх користувачів — будуємо і серіалізуємо їх один раз
+INVITATION_MARKUP = FrozenInlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Так", callback_data="yes"),
+        InlineKeyboardButton("Ні", callback_data="no")
+    ]
+])
+REGISTER_MARKUP = FrozenInlineKeyboardMarkup([[InlineKeyboardButton("Почати реєстрацію", callback_data="register")]])
+BACK_MARKUP = FrozenInlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="back")]])
+SOCIAL_MARKUP = FrozenInlineKeyboardMarkup([
+    [InlineKeyboardButton("Телеграм канал з додатковою інформацією", url="https://t.me/holytusa")],
+    [InlineKeyboardButton("Чат для спілкування та знайомств", url="https://t.me/+yOxlMtK2JDZlNWUy")],
+    [InlineKeyboardButton("Instagram", url="https://www.instagram.com/holy.tusa")]
+])
+
+# Reply-клавіатури кроків реєстрації
+CANCEL_MARKUP = ReplyKeyboardMarkup([["Відміна"]], one_time_keyboard=False, resize_keyboard=True)
+PHONE_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton("Поділитись контактом", request_contact=True)], ["Відміна"]],
+    one_time_keyboard=False,
+    resize_keyboard=True,
+)
+_INVITATION_CACHE = None  # (день, текст, розмітка)
+
+def get_invitation_message() -> tuple:
+    """
+    Повертає (текст, розмітку) запрошення.
+    Текст перебудовується лише після зміни налаштувань або зі зміною дня
+    (від поточної дати залежить день тижня заходу).
+    """
+    global _INVITATION_CACHE
+    today = datetime.date.today().toordinal()
+    cache = _INVITATION_CACHE
+    if cache is None or cache[0] != today:
+        with event_settings.lock:
+            weekday = get_weekday(event_settings.date)
+            message = (
+                f"Привіт! Запрошую тебе на вечірку в {weekday}, {event_settings.date}, початок о {event_settings.time}\n"
+                f"{event_settings.location}\n\n"
+                "Чи будеш ти з нами?"
+            )
+            cache = _INVITATION_CACHE = (today, message, INVITATION_MARKUP)
+    return cache[1], cache[2]
+
+def invalidate_invitation():
+    global _INVITATION_CACHE
+    _INVITATION_CACHE = None
 
 # === Константи для станів розмови ===
 NAME, PHONE, USERNAME, SOURCE = range(4)
 ADMIN_DATE, ADMIN_TIME, ADMIN_LOCATION, ADMIN_BROADCAST, ADMIN_EDIT_MESSAGE = range(4, 9)
 
+# Регулярні вирази та фільтри компілюються один раз при імпорті
+class _PhoneKeep(dict):
+    """Таблиця для str.translate: лишає цифри та "+", решту символів видаляє."""
+    def __missing__(self, key):
+        return None
+
+_PHONE_KEEP = _PhoneKeep((ord(c), c) for c in "0123456789+")
+_UA_PHONE_RE = re.compile(r"\+380\d{9}")
+_USERNAME_RE = re.compile(r"@[A-Za-z0-9_]{5,32}")  # правила Telegram: 5–32 латинські літери, цифри, _
+# Стоїть першим у кожному стані реєстрації, тож хендлери полів "Відміна" вже не бачать
+_CANCEL_RE = re.compile(r"^\s*відміна\s*$", re.IGNORECASE)
+CANCEL_FILTER = Filters.regex(_CANCEL_RE)
+
 # === Хендлери для користувача ===
 def start_command(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
@@ -235,16 +680,12 @@ def start_command(update: Update, context: CallbackContext):
 
 def starts(update: Update, context: CallbackContext):
     add_user(update.effective_chat.id)
-    msg = update.message.reply_text("\u2063", reply_markup=ReplyKeyboardRemove())
-    context.bot.delete_message(chat_id=update.effective_chat.id, message_id=msg.message_id)
-    text = get_invitation_message()
-    keyboard = [
-        [
-            InlineKeyboardButton("Так", callback_data="yes"),
-            InlineKeyboardButton("Ні", callback_data="no")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if context.user_data.pop("reply_keyboard", False):
+        # Користувач покинув реєстрацію з відкритою клавіатурою «Відміна» — прибираємо її.
+        # Інлайн-розмітка запрошення не може одночасно зняти reply-клавіатуру.
+        msg = update.message.reply_text("\u2063", reply_markup=ReplyKeyboardRemove())
+        context.bot.delete_message(chat_id=update.effective_chat.id, message_id=msg.message_id)
+    text, reply_markup = get_invitation_message()
     update.message.reply_text(text, reply_markup=reply_markup)
 
 def invitation_response(update: Update, context: CallbackContext):
@@ -257,16 +698,12 @@ def invitation_response(update: Update, context: CallbackContext):
     query.answer()
     if query.data == "yes":
         message_text = load_message_text()
-        keyboard = [[InlineKeyboardButton("Почати реєстрацію", callback_data="register")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=message_text, reply_markup=reply_markup)
+        context.bot.send_message(chat_id=update.effective_chat.id, text=message_text, reply_markup=REGISTER_MARKUP)
         return ConversationHandler.END
     elif query.data == "no":
-        keyboard = [[InlineKeyboardButton("Назад", callback_data="back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         query.edit_message_text(
             text="Зрозуміло! Тоді чекаємо тебе наступного разу, або ж передумай та приходь!",
-            reply_markup=reply_markup
+            reply_markup=BACK_MARKUP
         )
         return ConversationHandler.END
 
@@ -274,14 +711,7 @@ def back_handler(update: Update, context: CallbackContext):
     """Обробляє кнопку 'Назад'."""
     query = update.callback_query
     query.answer()
-    text = get_invitation_message()
-    keyboard = [
-        [
-            InlineKeyboardButton("Так", callback_data="yes"),
-            InlineKeyboardButton("Ні", callback_data="no")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text, reply_markup = get_invitation_message()
     query.edit_message_text(text=text, reply_markup=reply_markup)
 
 def registration_start(update: Update, context: CallbackContext):
@@ -299,54 +729,44 @@ def registration_start(update: Update, context: CallbackContext):
 
 def get_name(update: Update, context: CallbackContext):
     user_text = update.message.text
-    if user_text.strip().lower() == "відміна":
-        return cancel(update, context)
     context.user_data["name"] = user_text
-    contact_button = KeyboardButton("Поділитись контактом", request_contact=True)
-    reply_markup = ReplyKeyboardMarkup([[contact_button], ["Відміна"]], one_time_keyboard=False, resize_keyboard=True)
-    update.message.reply_text("Введіть номер телефону або поділіться контактом:", reply_markup=reply_markup)
+    update.message.reply_text("Введіть номер телефону або поділіться контактом:", reply_markup=PHONE_MARKUP)
+    context.user_data["reply_keyboard"] = True
     return PHONE
 
 def get_phone(update: Update, context: CallbackContext):
     if update.message.contact:
         phone = update.message.contact.phone_number
     else:
-        phone = update.message.text.strip()
-        if phone.lower() == "відміна":
-            return cancel(update, context)
-    phone = re.sub(r"[^\d+]", "", phone)
+        phone = update.message.text
+    phone = phone.translate(_PHONE_KEEP)
     if not phone.startswith("+"):
         phone = "+" + phone
-    logger.info("Очищений номер телефону: %s", phone)
-    if not (phone.startswith("+380") and len(phone) == 13 and phone[1:].isdigit()):
+    logger.debug("Очищений номер телефону: %s", phone)
+    if not _UA_PHONE_RE.fullmatch(phone):
         update.message.reply_text("Будь ласка, введіть коректний номер телефону у форматі +380XXXXXXXXX.")
         return PHONE
     context.user_data["phone"] = phone
-    reply_markup = ReplyKeyboardMarkup([["Відміна"]], one_time_keyboard=False, resize_keyboard=True)
-    update.message.reply_text("Введіть ваш Telegram нік (через @):", reply_markup=reply_markup)
+    update.message.reply_text("Введіть ваш Telegram нік (через @):", reply_markup=CANCEL_MARKUP)
     return USERNAME
 
 def get_username(update: Update, context: CallbackContext):
     username = update.message.text.strip()
-    if username.lower() == "відміна":
-        return cancel(update, context)
-    if not username.startswith("@"):
-        update.message.reply_text("Будь ласка, введіть ваш Telegram нік, який починається з @.")
+    if not _USERNAME_RE.fullmatch(username):
+        update.message.reply_text("Будь ласка, введіть ваш Telegram нік, який починається з @ (наприклад, @username).")
         return USERNAME
     context.user_data["username"] = username
-    reply_markup = ReplyKeyboardMarkup([["Відміна"]], one_time_keyboard=False, resize_keyboard=True)
     update.message.reply_text(
         "Де ви побачили інформацію про вечірку?\n(наприклад: інстаграм реклама, інстаграм сторінка, телеграм канал Холі, інший телеграм канал)",
-        reply_markup=reply_markup
+        reply_markup=CANCEL_MARKUP
     )
     return SOURCE
 
 def get_source(update: Update, context: CallbackContext):
     source_text = update.message.text.strip()
-    if source_text.lower() == "відміна":
-        return cancel(update, context)
     context.user_data["source"] = source_text
-    store_registration(context.user_data)
+    context.user_data.pop("reply_keyboard", None)
+    EXECUTOR.submit(store_registration, dict(context.user_data))
     update.message.reply_text(
         "Дякуємо за реєстрацію, чекаємо вас на вході для перевірки інформації 🫶🏻",
         reply_markup=ReplyKeyboardRemove()
@@ -355,16 +775,11 @@ def get_source(update: Update, context: CallbackContext):
         "Залишайся з ботом до самої вечірки, адже через нього тобі будуть надходити важливі повідомлення!\n\n"
         "Підпишись на наші соціальні мережі та будь в курсі новин 👇🏻"
     )
-    keyboard = [
-        [InlineKeyboardButton("Телеграм канал з додатковою інформацією", url="https://t.me/holytusa")],
-        [InlineKeyboardButton("Чат для спілкування та знайомств", url="https://t.me/+yOxlMtK2JDZlNWUy")],
-        [InlineKeyboardButton("Instagram", url="https://www.instagram.com/holy.tusa")]
-    ]
-    reply_markup_inline = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text(social_text, reply_markup=reply_markup_inline)
+    update.message.reply_text(social_text, reply_markup=SOCIAL_MARKUP)
     return ConversationHandler.END
 
 def cancel(update: Update, context: CallbackContext):
+    context.user_data.pop("reply_keyboard", None)
     update.message.reply_text("Реєстрацію скасовано.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
@@ -397,36 +812,137 @@ def admin_callback(update: Update, context: CallbackContext):
         return ADMIN_EDIT_MESSAGE
 
 def admin_set_date(update: Update, context: CallbackContext):
-    global event_date
-    event_date = update.message.text
+    with event_settings.lock:
+        event_settings.date = update.message.text
+        invalidate_invitation()
+    # Аркуші могли змінити вручну — наступний запис перечитає їх список
+    invalidate_worksheets()
     update.message.reply_text("Введіть новий час заходу (формат гг:хх):")
     return ADMIN_TIME
 
 def admin_set_time(update: Update, context: CallbackContext):
-    global event_time
-    event_time = update.message.text
+    with event_settings.lock:
+        event_settings.time = update.message.text
+        invalidate_invitation()
     update.message.reply_text("Введіть нову локацію:")
     return ADMIN_LOCATION
 
 def admin_set_location(update: Update, context: CallbackContext):
-    global event_location
-    event_location = update.message.text
-    save_settings()
+    with event_settings.lock:
+        event_settings.location = update.message.text
+        invalidate_invitation()
+    schedule_save_settings()
     update.message.reply_text("Інформація про захід оновлена!")
     return ConversationHandler.END
 
+class TokenBucket:
+    """Обмежувач частоти: не більше rate запитів на секунду зі сплеском до burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.updated:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                # Під час паузи updated лежить у майбутньому: чекаємо її кінця і першого токена
+                wait = max(self.updated - now, 0) + (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Зупиняє видачу токенів усім потокам на seconds (наприклад, на retry_after від Telegram)."""
+        with self.lock:
+            resume = time.monotonic() + seconds
+            if resume > self.updated:
+                self.updated = resume
+                self.tokens = 0.0
+
+# Telegram дозволяє ~30 повідомлень/с на бота — тримаємося трохи нижче
+BROADCAST_LIMITER = TokenBucket(rate=28, burst=30)
+BROADCAST_MAX_ATTEMPTS = 3
+# Тихі розсилки (без звуку сповіщення) Telegram обмежує м'якше; вмикається BROADCAST_SILENT=1
+BROADCAST_SILENT = os.environ.get("BROADCAST_SILENT", "").lower() in ("1", "true", "yes")
+# Окрема черга (chat_id, BroadcastJob) на кожен потік розсилки. Чат завжди потрапляє
+# в ту саму чергу, а повтори виконуються на місці, тож повідомлення одному користувачу
+# йдуть по черзі, а повільний користувач затримує лише свою частку, а не всю розсилку.
+BROADCAST_QUEUES = [queue.Queue() for _ in range(BROADCAST_WORKERS)]
+
+def broadcast_queue_for(uid: int) -> queue.Queue:
+    return BROADCAST_QUEUES[hash(uid) % BROADCAST_WORKERS]
+
+class BroadcastJob:
+    """Одна розсилка: рахує результати відправок і звітує адміну, коли оброблено всіх."""
+
+    def __init__(self, admin_chat_id: int, text: str, total: int):
+        self.admin_chat_id = admin_chat_id
+        self.text = text
+        self.remaining = total
+        self.delivered = 0
+        self.lock = Lock()
+
+    def done(self, bot: Bot, delivered: bool):
+        with self.lock:
+            self.remaining -= 1
+            if delivered:
+                self.delivered += 1
+            finished = self.remaining == 0
+        if finished:
+            try:
+                bot.send_message(
+                    chat_id=self.admin_chat_id,
+                    text=f"Розсилка завершена. Повідомлення відправлено {self.delivered} користувачам."
+                )
+            except Exception as e:
+                logger.error("Помилка відправки звіту про розсилку: %s", e)
+
+def broadcast_worker(bot: Bot, jobs: queue.Queue):
+    """Бере повідомлення зі своєї черги jobs і відправляє їх у межах спільного BROADCAST_LIMITER."""
+    while True:
+        uid, job = jobs.get()
+        try:
+            job.done(bot, send_broadcast_message(bot, uid, job.text))
+        finally:
+            jobs.task_done()
+
+def send_broadcast_message(bot: Bot, uid: int, text: str) -> bool:
+    """Відправляє одне повідомлення; на RetryAfter пригальмовує всі потоки і повторює його ж."""
+    for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+        BROADCAST_LIMITER.acquire()
+        try:
+            bot.send_message(chat_id=uid, text=text, disable_notification=BROADCAST_SILENT)
+            return True
+        except RetryAfter as e:
+            logger.warning("Ліміт Telegram, повтор для %s через %s с (спроба %d)", uid, e.retry_after, attempt)
+            BROADCAST_LIMITER.pause(e.retry_after)
+        except Exception as e:
+            logger.error("Помилка відправки повідомлення користувачу %s: %s", uid, e)
+            return False
+    logger.error("Не вдалося відправити повідомлення користувачу %s: вичерпано спроби", uid)
+    return False
+
+def start_broadcast_workers(bot: Bot):
+    for i, jobs in enumerate(BROADCAST_QUEUES):
+        Thread(target=broadcast_worker, args=(bot, jobs), name=f"broadcast-{i}", daemon=True).start()
+
 def admin_broadcast_message(update: Update, context: CallbackContext):
     message_text = update.message.text
-    users = load_users()
+    with _users_lock:
+        users = list(USERS)
     if users:
-        count = 0
+        job = BroadcastJob(update.effective_chat.id, message_text, len(users))
         for uid in users:
-            try:
-                context.bot.send_message(chat_id=int(uid), text=message_text)
-                count += 1
-            except Exception as e:
-                logger.error("Помилка відправки повідомлення користувачу %s: %s", uid, e)
-        update.message.reply_text(f"Розсилка завершена. Повідомлення відправлено {count} користувачам.")
+            broadcast_queue_for(uid).put((uid, job))
+        update.message.reply_text(f"Розсилку поставлено в чергу для {len(users)} користувачів.")
     else:
         update.message.reply_text("Немає користувачів для розсилки.")
     return ConversationHandler.END
@@ -444,17 +960,75 @@ def admin_cancel(update: Update, context: CallbackContext):
 def error_handler(update: object, context: CallbackContext):
     logger.error("Виникла помилка: ", exc_info=context.error)
 
+# Мінімальний HTTP-застосунок для health-check Render
+app = Flask(__name__)
+
+@app.route("/")
+def index():
+    return "OK", 200
+
+class HealthCheckHandler(tornado.web.RequestHandler):
+    """Той самий "/" для health-check, але на вебхук-сервері PTB (tornado), що обробляє лише /TOKEN."""
+
+    def get(self):
+        self.write("OK")
+
+    def head(self):
+        pass
+
+class ConversationPersistence(PicklePersistence):
+    """
+    PicklePersistence, що пише файл атомарно: невдалий запис не залишає порожній
+    ptb_state.pkl, з яким бот не запуститься.
+    """
+
+    def flush(self) -> None:
+        try:
+            super().flush()
+        except Exception as e:
+            # Викликається з обробника сигналу перед зупинкою — помилка не має зірвати завершення
+            logger.error("Помилка збереження стану розмов у %s: %s", self.filename, e)
+
+    def _dump_singlefile(self) -> None:
+        data = {
+            "conversations": self.conversations,
+            "user_data": self.user_data,
+            "chat_data": self.chat_data,
+            "bot_data": self.bot_data,
+            "callback_data": self.callback_data,
+        }
+        write_file_atomic(self.filename, pickle.dumps(data))
+
 def main():
     load_settings()      # Завантаження налаштувань із внутрішнього сховища
     load_users()         # Завантаження списку користувачів із внутрішнього сховища
     load_message_text()  # Завантаження або створення файлу повідомлення
 
-    updater = Updater(TOKEN, use_context=True)
+    updater = Updater(
+        TOKEN,
+        workers=WORKERS,
+        use_context=True,
+        # Стан розмов і user_data переживають перезапуск; файл пишеться лише при зупинці
+        persistence=ConversationPersistence(
+            filename=PERSISTENCE_FILE,
+            store_user_data=True,
+            store_chat_data=False,
+            store_bot_data=False,
+            single_file=True,
+            on_flush=True,
+        ),
+        # Пул keep-alive з'єднань має вміщати потоки розсилки, воркери і 4 внутрішні потоки
+        # Updater, інакше urllib3 серіалізує запити. Таймаути — типові для PTB (5 с).
+        request_kwargs={"con_pool_size": BROADCAST_WORKERS + WORKERS + 4},
+    )
     dp = updater.dispatcher
+    start_broadcast_workers(updater.bot)
 
-    # Хендлери для користувача
-    dp.add_handler(CommandHandler("start", start_command))
-    dp.add_handler(CommandHandler("starts", starts))
+    # Хендлери поза розмовами (кілька викликів Telegram на кожен) виконуються у пулі воркерів.
+    # Хендлери ConversationHandler лишаються синхронними: поки run_async-хендлер розмови не
+    # завершився, ConversationHandler ігнорує наступні повідомлення цього користувача.
+    dp.add_handler(CommandHandler("start", start_command, run_async=True))
+    dp.add_handler(CommandHandler("starts", starts, run_async=True))
     invitation_conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(invitation_response, pattern="^(yes|no)$")],
         states={},
@@ -465,26 +1039,28 @@ def main():
         entry_points=[CallbackQueryHandler(registration_start, pattern="^register$")],
         states={
             NAME: [
+                MessageHandler(CANCEL_FILTER, cancel),
                 MessageHandler(Filters.text & ~Filters.command, get_name),
-                MessageHandler(Filters.regex("^Відміна$"), cancel)
             ],
             PHONE: [
+                MessageHandler(CANCEL_FILTER, cancel),
                 MessageHandler(Filters.contact | (Filters.text & ~Filters.command), get_phone),
-                MessageHandler(Filters.regex("^Відміна$"), cancel)
             ],
             USERNAME: [
+                MessageHandler(CANCEL_FILTER, cancel),
                 MessageHandler(Filters.text & ~Filters.command, get_username),
-                MessageHandler(Filters.regex("^Відміна$"), cancel)
             ],
             SOURCE: [
+                MessageHandler(CANCEL_FILTER, cancel),
                 MessageHandler(Filters.text & ~Filters.command, get_source),
-                MessageHandler(Filters.regex("^Відміна$"), cancel)
             ],
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="registration",
+        persistent=True,
     )
     dp.add_handler(reg_conv_handler)
-    dp.add_handler(CommandHandler("admin", admin))
+    dp.add_handler(CommandHandler("admin", admin, run_async=True))
     admin_conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(admin_callback, pattern="^(admin_change|admin_broadcast|admin_edit_message)$")],
         states={
@@ -494,25 +1070,52 @@ def main():
             ADMIN_BROADCAST: [MessageHandler(Filters.text & ~Filters.command, admin_broadcast_message)],
             ADMIN_EDIT_MESSAGE: [MessageHandler(Filters.text & ~Filters.command, admin_set_message)],
         },
-        fallbacks=[CommandHandler("cancel", admin_cancel)]
+        fallbacks=[CommandHandler("cancel", admin_cancel)],
+        name="admin",
+        persistent=True,
     )
     dp.add_handler(admin_conv_handler)
-    dp.add_handler(CallbackQueryHandler(back_handler, pattern="^back$"))
+    dp.add_handler(CallbackQueryHandler(back_handler, pattern="^back$", run_async=True))
     dp.add_error_handler(error_handler)
 
-    # Запуск long polling
-    updater.start_polling()
-    logger.info("Бот запущено у режимі long polling!")
-
-    # Мінімальний HTTP-сервер для Render
-    app = Flask(__name__)
-    @app.route("/")
-    def index():
-        return "OK", 200
     port = int(os.environ.get("PORT", 10000))
-    Thread(target=lambda: app.run(host="0.0.0.0", port=port)).start()
+    if WEBHOOK_URL:
+        # Вебхук обслуговує вбудований сервер PTB на порту Render, Flask не потрібен.
+        updater.start_webhook(
+            listen="0.0.0.0",
+            port=port,
+            url_path=TOKEN,
+            webhook_url=WEBHOOK_URL.rstrip("/") + "/" + TOKEN,
+            bootstrap_retries=BOOTSTRAP_RETRIES,
+        )
+        # Сервер PTB знає лише /TOKEN — додаємо "/" для health-check Render, як у режимі polling.
+        # Маршрути змінюємо в потоці його IOLoop, бо сервер уже приймає запити.
+        httpd = updater.httpd
+        if httpd is not None and httpd.loop is not None:
+            httpd.loop.add_callback(
+                httpd.http_server.request_callback.add_handlers, r".*", [(r"/", HealthCheckHandler)]
+            )
+        logger.info("Бот запущено у режимі webhook!")
+    else:
+        # Запуск long polling
+        updater.start_polling()  # типово bootstrap_retries=-1: deleteWebhook повторюється безкінечно
+        logger.info("Бот запущено у режимі long polling!")
+
+        # Мінімальний HTTP-сервер для Render (daemon, щоб не тримав процес після зупинки бота)
+        Thread(target=lambda: app.run(host="0.0.0.0", port=port, threaded=True), daemon=True).start()
 
     updater.idle()
 
+    # Дописуємо реєстрації та налаштування, що ще чекають, перед виходом
+    EXECUTOR.shutdown(wait=True)
+    flush_registrations()
+    # Те, що повернулося в буфер після невдалого запису, зберігаємо у файл, а не втрачаємо з процесом
+    with _pending_lock:
+        left = list(_pending_rows)
+        _pending_rows.clear()
+    for sheet_name, row in left:
+        save_failed_registrations(sheet_name, [row])
+    flush_settings()
+
 if __name__ == "__main__":
     main()